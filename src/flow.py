@@ -5,7 +5,7 @@
 # REQUIREMENTS
 # - Detailed dependencies in requirements.txt
 # - Directly referenced:
-#   - prefect, boto3, tqdm, pandas, icecream, coiled
+#   - prefect, boto3, tqdm, pyarrow, icecream, coiled
 #
 # - Infrastructure:
 #   - Prefect: Script is registered as a Prefect flow with api.prefect.io
@@ -22,17 +22,31 @@
 # - Map: Removes files that are missing spatial data
 # - Map: Removes files that have inconsistent spatial data (i.e., latitude changes part of
 #        the way through the year in such a way that seems like a mistake)
-# - Reduce: Takes the site data files from each year and creates a single file for
+# - Map: Writes a Parquet copy of each cleaned site file next to the CSV (year/site.parquet)
+# - Map (per year, only with CONVERT_PARQUET): Runs every site CSV that still has no Parquet copy
+#   through the same checks (one-time migration of existing files); this lists each year again and
+#   is NOT bounded by TOTAL_PROCESSED
+# - Tags the cleaned site files ('lastmodified') with a single S3 Batch Operations job per run
+#   (per-file tagging calls if no BATCH_ROLE_ARN is given)
+# - Reduce: Takes the site Parquet files from each year and creates a single file for
 #           the year that contains the yearly averages for each temperature site
+#   - Written as Parquet (year_average/avg_YEAR.parquet)
 #   - The data in these new files will be inserted into a PostgreSQL database
 ##############################################################################
 
 # import coiled
 
+import csv
 import logging
+import operator
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
 from typing import List
 from datetime import datetime, timedelta
+from urllib.parse import quote
 from dateutil.tz import tzutc
 
 # PyPI
@@ -40,41 +54,115 @@ import prefect
 from prefect import task, Flow, Parameter
 
 # from prefect.engine.executors.dask import DaskExecutor, LocalDaskExecutor
-from prefect.executors.dask import DaskExecutor, LocalDaskExecutor
+from prefect.executors.dask import DaskExecutor
 from prefect.utilities.edges import unmapped, mapped
 from prefect.run_configs.local import LocalRun
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from tqdm import tqdm
-import pandas as pd
-from pandas.errors import EmptyDataError
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs as pafs
 from icecream import ic
 
 
+SPATIAL_COLUMNS = ["STATION", "LATITUDE", "LONGITUDE", "ELEVATION"]
+MEASUREMENT_COLUMNS = ["TEMP", "DEWP", "STP", "MIN", "MAX", "PRCP"]
+# concurrent S3 requests per task (per-file GET/PUT/COPY in process_year_files)
+S3_MAX_WORKERS = 32
+# Dask threads per worker process (see executor); each can run a task with S3_MAX_WORKERS threads
+DASK_THREADS_PER_WORKER = 2
+# LIST requests for a year are split into key ranges at these leading filename characters
+# ('year/' .. 'year/1', 'year/1' .. 'year/2', ... 'year/9' ..) and paginated concurrently
+S3_LIST_SHARD_BOUNDS = "123456789"
+# connections kept by the worker's shared boto3 client; botocore's default of 10 would discard
+# (and later re-handshake) most of the connections opened by the per-file pools (process_year_files,
+# tag_cleaned_files without a role) and the concurrent LIST ranges (list_s3_objects, one per bound + 1)
+S3_MAX_POOL_CONNECTIONS = max(S3_MAX_WORKERS, len(S3_LIST_SHARD_BOUNDS) + 1) * DASK_THREADS_PER_WORKER
+# S3 Batch Operations manifests for tag_cleaned_files (left out of the year folders by fetch_aws_folders)
+BATCH_MANIFEST_FOLDER = "_batch_manifests"
+# explicit types for the columns the flow uses; anything else is inferred by the Arrow reader
+# - spatial fields stay strings so a change like 1 decimal -> 2 decimals counts as a different value;
+#   they are dictionary encoded, so the distinct values in a file are just the dictionary entries
+# - measurements are float32; NOAA reports them to 1-2 decimals, and the means accumulate in float64
+# - blank fields (quoted or not) are read as null, so missing spatial data can be detected
+SITE_COLUMN_TYPES = {
+    "STATION": pa.dictionary(pa.int32(), pa.string()),
+    "DATE": pa.string(),
+    "LATITUDE": pa.dictionary(pa.int32(), pa.string()),
+    "LONGITUDE": pa.dictionary(pa.int32(), pa.string()),
+    "ELEVATION": pa.dictionary(pa.int32(), pa.string()),
+    "FRSHTT": pa.string(),
+    "TEMP": pa.float32(),
+    "DEWP": pa.float32(),
+    "STP": pa.float32(),
+    "MIN": pa.float32(),
+    "MAX": pa.float32(),
+    "PRCP": pa.float32(),
+}
+CSV_CONVERT_OPTIONS = pv.ConvertOptions(
+    column_types=SITE_COLUMN_TYPES, strings_can_be_null=True, quoted_strings_can_be_null=True
+)
+# columns calculate_year_csv scans from the site Parquet copies; giving the dataset this schema
+# skips inferring it from the first file and reads only these columns
+SITE_PARQUET_SCHEMA = pa.schema([(x, SITE_COLUMN_TYPES[x]) for x in SPATIAL_COLUMNS + MEASUREMENT_COLUMNS])
+
+
 ########################
 # SUPPORTING FUNCTIONS #
 ########################
+@lru_cache(maxsize=None)
 def initialize_s3_client(region_name: str) -> boto3.client:
-    return boto3.client("s3", region_name=region_name)
+    """boto3 S3 client, created once per worker
+    - Building a client (credential resolution, endpoint setup) is slow; clients are safe
+      to share between threads, so every task and thread on the worker reuses this one
+    - Uses its own Session; the boto3 default session isn't safe to create clients from concurrently
+    - Connection pool sized for every thread that shares it (S3_MAX_POOL_CONNECTIONS)
+    """
+    config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+    return boto3.session.Session().client("s3", region_name=region_name, config=config)
 
 
-def csv_clean_spatial_check(filename, data):
-    records = pd.read_csv(
-        data,  # working_dir / file_,
-        dtype={"FRSHTT": str, "TEMP": str, "LATITUDE": str, "LONGITUDE": str, "ELEVATION": str, "DATE": str},
-    )
-    records.columns = records.columns.str.strip()
-    # remove site files with no spatial data
-    if (
-        not records["STATION"].eq(records["STATION"].iloc[0]).all()
-        or not records["LATITUDE"].eq(records["LATITUDE"].iloc[0]).all()
-        or not records["LONGITUDE"].eq(records["LONGITUDE"].iloc[0]).all()
-        or not records["ELEVATION"].eq(records["ELEVATION"].iloc[0]).all()
-    ):
+@lru_cache(maxsize=None)
+def initialize_s3_filesystem(region_name: str) -> pafs.S3FileSystem:
+    """Arrow's native S3 filesystem, created once per worker
+    - GETs run in Arrow's C++ client and release the GIL, so reads in parallel
+      Dask threads don't serialize on Python the way boto3 streaming bodies do
+    - Paths are 'bucket/key'
+    """
+    return pafs.S3FileSystem(region=region_name)
+
+
+def read_site_csv(data) -> pa.Table:
+    """Parse a NOAA site CSV with the Arrow (multithreaded C++) reader
+    Args:
+        data: file-like object or pyarrow input stream containing the CSV
+
+    Return (pa.Table): site records, typed per CSV_CONVERT_OPTIONS; dictionary columns
+        share one dictionary across chunks
+    """
+    contents = data.read()
+    # strip the header names before parsing; CSV_CONVERT_OPTIONS types are keyed by the clean names,
+    # so a padded header (e.g., ' LATITUDE') would otherwise get an inferred type
+    header = next(csv.reader([contents.split(b"\n", 1)[0].decode("utf-8-sig")]), [])
+    read_options = pv.ReadOptions(column_names=[x.strip() for x in header], skip_rows=1)
+    records = pv.read_csv(pa.BufferReader(contents), read_options=read_options, convert_options=CSV_CONVERT_OPTIONS)
+    # each parsed block gets its own dictionary; unify so chunk(0).dictionary covers the whole column
+    return records.unify_dictionaries()
+
+
+def csv_clean_spatial_check(filename, records: pa.Table):
+    # remove site files with no spatial data (no rows, or any blank spatial field);
+    # changing values are handled by unique_values_spatial_check
+    if records.num_rows == 0 or any(column_missing_values_check(records[x]) for x in SPATIAL_COLUMNS):
         return filename
 
 
-def unique_values_spatial_check(filename, data):
+def unique_values_spatial_check(filename, records: pa.Table):
     """Ensure spatial fields are consistent for a site
     - The spatial fields (latitude, lontitude, elevation) should be the same
       for a site over the course of the year. There are NOAA temp files
@@ -85,37 +173,72 @@ def unique_values_spatial_check(filename, data):
         or an integer becomes a float. These should be identified and corrected.
     - Also checks to ensure the station ID number doesn't change in the file.
     """
-    try:
-        records = pd.read_csv(
-            data,  # working_dir / file_,
-            dtype={"FRSHTT": str, "TEMP": str, "LATITUDE": str, "LONGITUDE": str, "ELEVATION": str, "DATE": str},
-        )
-        records.columns = records.columns.str.strip()
-        site_number = column_unique_values_check(records["STATION"])
-        latitude = column_unique_values_check(records["LATITUDE"])
-        longitude = column_unique_values_check(records["LONGITUDE"])
-        elevation = column_unique_values_check(records["ELEVATION"])
-        if site_number == "X":
-            return filename
-        if latitude == "X":
-            return filename
-        if longitude == "X":
-            return filename
-        if elevation == "X":
-            return filename
-    except EmptyDataError as e:
-        return "X"
-    # except KeyError as e:
-    #     return 'X'
-    except pd.errors.ParserError as e:
-        return "X"
+    site_number = column_unique_values_check(records["STATION"])
+    latitude = column_unique_values_check(records["LATITUDE"])
+    longitude = column_unique_values_check(records["LONGITUDE"])
+    elevation = column_unique_values_check(records["ELEVATION"])
+    if site_number == "X":
+        return filename
+    if latitude == "X":
+        return filename
+    if longitude == "X":
+        return filename
+    if elevation == "X":
+        return filename
 
 
-def column_unique_values_check(column) -> str:
-    value_l = column.unique()
+def column_unique_values_check(column: pa.ChunkedArray) -> str:
+    # header-only file; csv_clean_spatial_check reports it as missing
+    if column.num_chunks == 0:
+        return None
+    # dictionary encoded (see read_site_csv), so this is a length check rather than a hash of every value
+    value_l = column.chunk(0).dictionary
     if len(value_l) > 1:
         return "X"
-    return value_l[0]
+    # an all-blank column has no values at all; csv_clean_spatial_check reports it as missing
+    if len(value_l) == 0:
+        return None
+    return value_l[0].as_py()
+
+
+def column_missing_values_check(column: pa.ChunkedArray) -> bool:
+    # blank fields are read as null (see CSV_CONVERT_OPTIONS); "" is checked as well in case one gets through
+    if column.null_count > 0 or column.num_chunks == 0:
+        return True
+    value_l = column.chunk(0).dictionary
+    return len(value_l) == 0 or "" in value_l.to_pylist()
+
+
+def list_s3_objects(s3_client: boto3.client, bucket_name: str, prefix: str) -> List[dict]:
+    """List every object under a prefix, paginating disjoint key ranges concurrently
+    - A single paginator is sequential (each page needs the previous page's token), so the
+      keys under 'prefix/' are split at S3_LIST_SHARD_BOUNDS and each range is listed in its
+      own thread, starting with StartAfter and stopping once it passes the next bound
+    Args:
+        s3_client: initated boto3 s3_client object
+        bucket_name (str): target AWS bucket
+        prefix (str): key prefix (i.e., year folder)
+
+    Return (List[dict]): 'Contents' entries from list_objects_v2, in key order
+    """
+    bounds = [None] + [f"{prefix}/{x}" for x in S3_LIST_SHARD_BOUNDS] + [None]
+
+    def list_range(start_after, stop_after):
+        paginator = s3_client.get_paginator("list_objects_v2")
+        kwargs = {"Bucket": bucket_name, "Prefix": prefix, "PaginationConfig": {"PageSize": 1000}}
+        if start_after:
+            kwargs["StartAfter"] = start_after
+        objects = []
+        for page in paginator.paginate(**kwargs):
+            for x in page.get("Contents", []):
+                if stop_after and x["Key"] > stop_after:
+                    return objects
+                objects.append(x)
+        return objects
+
+    with ThreadPoolExecutor(max_workers=len(bounds) - 1) as executor:
+        ranges = executor.map(list_range, bounds[:-1], bounds[1:])
+        return [x for objects in ranges for x in objects]
 
 
 def aws_year_files(year: str, bucket_name: str, region_name: str):
@@ -123,37 +246,68 @@ def aws_year_files(year: str, bucket_name: str, region_name: str):
     # if year == '':
     #     return []
     s3_client = initialize_s3_client(region_name)
-    aws_file_set = set()
-    paginator = s3_client.get_paginator("list_objects_v2")
-    pages = paginator.paginate(Bucket=bucket_name, Prefix=year)
-    for page in pages:
-        list_all_keys = page["Contents"]
-        # item arrives in format of 'year/filename'; this extracts that
-        file_l = [x["Key"] for x in list_all_keys]
-        for f in file_l:
-            aws_file_set.add(f)
-    return list(sorted(aws_file_set))
+    # item arrives in format of 'year/filename'; ranges are disjoint, so keys are already unique
+    return [x["Key"] for x in list_s3_objects(s3_client, bucket_name, year)]
 
 
 def move_s3_file(filename: str, bucket_name: str, s3_client: boto3.client, note: str):
     try:
-        # create bucket object
-        s3_resource = boto3.resource("s3")
-        bucket = s3_resource.Bucket(bucket_name)
-        # ensure data error folder exists
-        s3_client.put_object(Bucket=bucket_name, Body="", Key=f"_data_error/")
+        # no folder marker needed for '_data_error/'; S3 prefixes exist as soon as a key uses them
         # ensure year folder exists
         # s3_client.put_object(Bucket=bucket_name, Body='', Key=f'_data_errors/{filename.split("/")[0]}/')
         # Copy object A as object B
         year, file_ = filename.split("/")
         number = file_.split(".")[0]
         copy_source = {"Bucket": bucket_name, "Key": filename}
-        bucket.copy(copy_source, f"_data_error/{year}-{number}-{note}.csv")
+        s3_client.copy(copy_source, bucket_name, f"_data_error/{year}-{number}-{note}.csv")
         # Delete object A
     except ValueError as e:
         if "not enough values to unpack" not in str(e):
             raise ValueError(e)
-    s3_resource.Object(bucket_name, filename).delete()
+    s3_client.delete_object(Bucket=bucket_name, Key=filename)
+    # drop the Parquet copy as well so it isn't picked up by calculate_year_csv
+    s3_client.delete_object(Bucket=bucket_name, Key=f'{filename.rsplit(".", 1)[0]}.parquet')
+
+
+def process_site_file(filename: str, bucket_name: str, s3_client: boto3.client, s3_fs: pafs.S3FileSystem):
+    """Check one site CSV and move it to '_data_error' or write its Parquet copy
+    - Used by process_year_files (new/changed files) and convert_year_files_parquet (files
+      without a Parquet copy yet)
+
+    Return (str): filename if the file is clean (tagged later by tag_cleaned_files), else None
+    """
+    if len(filename) <= 5:
+        return
+    if filename.endswith(".parquet"):
+        return
+    if "year_average" in filename or "_data_error" in filename:
+        return
+    try:
+        # fetch and parse once; both checks share the table
+        with s3_fs.open_input_stream(f"{bucket_name}/{filename}") as data:
+            records = read_site_csv(data)
+        non_unique_spatial = unique_values_spatial_check(filename=filename, records=records)
+        if non_unique_spatial:
+            move_s3_file(non_unique_spatial, bucket_name, s3_client, note="non_unique_spatial")
+            print("uploaded")
+            return
+        spatial_errors = csv_clean_spatial_check(filename=filename, records=records)
+        if spatial_errors:
+            move_s3_file(spatial_errors, bucket_name, s3_client, note="missing_spatial")
+            return
+        if not non_unique_spatial and not spatial_errors:
+            # s3_client.put_object(Body=data, Bucket=bucket_name, Key=filename)#f'year_average/avg_{year_folder}.csv')
+            # calculate_year_csv reads the Parquet copy; written from the table already parsed above
+            with s3_fs.open_output_stream(f'{bucket_name}/{filename.rsplit(".", 1)[0]}.parquet') as data:
+                pq.write_table(records, data, compression="zstd")
+            # tagged later, all at once, by tag_cleaned_files
+            return filename
+    # empty files and malformed rows both surface as ArrowInvalid
+    except pa.ArrowInvalid as e:
+        move_s3_file(filename, bucket_name, s3_client, note="parse_error")
+    # pyarrow raises FileNotFoundError for a missing key; nothing left to move
+    except FileNotFoundError as e:
+        print(f"{filename} no longer exists")
 
 
 def s3_upload_file(s3_client: boto3.client, file_name, bucket, object_name=None):
@@ -197,44 +351,35 @@ def fetch_aws_folders(region_name, bucket_name):
     # remove '/' from end of each folder name
     folder_list = [x.split("/")[0] for x in folder_list]
     # ic(folder_list)
-    folder_list = [x for x in folder_list if x != ""]
+    # the Batch Operations manifest folder isn't site data; keep it out of every year-mapped task
+    folder_list = [x for x in folder_list if x not in ("", BATCH_MANIFEST_FOLDER)]
     return sorted(folder_list)
     # return ['1929']
 
 
 @task(log_stdout=True, max_retries=5, retry_delay=timedelta(seconds=5))
 def aws_all_year_files(
-    year: list, bucket_name: str, region_name: str, min_old: int, time_less_than: bool, wait_for=None
+    year: list, bucket_name: str, region_name: str, min_old: int, time_less_than: bool, file_suffix: str = ".csv"
 ):
     # if len(year) > 4:
     #     return []
     # if year == 'year_average':
     #     return
     s3_client = initialize_s3_client(region_name)
-    aws_file_set = set()
-    paginator = s3_client.get_paginator("list_objects_v2")
-    pages = paginator.paginate(Bucket=bucket_name, Prefix=year)
-    for page in pages:
-        list_all_keys = page["Contents"]
-        # item arrives in format of 'year/filename'; this extracts that
-        if time_less_than:
-            # find files modified LESS than "min_old" minutes ago (standard run to process only newer files)
-            file_l = [
-                x["Key"]
-                for x in list_all_keys
-                if x["LastModified"] > datetime.now(tzutc()) - timedelta(minutes=min_old)
-            ]
-        else:
-            # fild files modified M)RE than "min_old" minutes ago
-            file_l = [
-                x["Key"]
-                for x in list_all_keys
-                if x["LastModified"] < datetime.now(tzutc()) - timedelta(minutes=min_old)
-            ]
-        for f in file_l:
-            aws_file_set.add(f)
-        # break
-    aws_file_l = list(sorted(aws_file_set))
+    # LIST can only narrow by key prefix, not LastModified (a paginator .search() expression is
+    # evaluated client-side after the page arrives), so the whole year is listed and filtered here
+    list_all_keys = list_s3_objects(s3_client, bucket_name, year)
+    cutoff = datetime.now(tzutc()) - timedelta(minutes=min_old)
+    # time_less_than: find files modified LESS than "min_old" minutes ago (standard run to process only newer files)
+    # otherwise: find files modified MORE than "min_old" minutes ago
+    compare_modified = operator.gt if time_less_than else operator.lt
+    # item arrives in format of 'year/filename'; this extracts that
+    # - file_suffix: site CSVs by default, so the Parquet copies don't take up TOTAL_PROCESSED/map slots
+    aws_file_l = [
+        x["Key"]
+        for x in list_all_keys
+        if x["Key"].endswith(file_suffix) and compare_modified(x["LastModified"], cutoff)
+    ]
     return aws_file_l
 
 
@@ -245,8 +390,8 @@ def aws_lists_prep_for_map(file_l: list, list_size: int, total_processed: int, w
         for i in range(0, len(file_l), list_size):
             yield file_l[i : i + list_size]
 
-    file_l_consolidated = [i for l in file_l for i in l]
-    file_l_consolidated = file_l_consolidated[:total_processed]
+    # flatten lazily and stop at total_processed rather than building the full list first
+    file_l_consolidated = list(islice(chain.from_iterable(file_l), total_processed))
     file_l_consolidated = list(chunks(file_l_consolidated, list_size))
     ic(len(file_l_consolidated))
     return file_l_consolidated
@@ -256,84 +401,142 @@ def aws_lists_prep_for_map(file_l: list, list_size: int, total_processed: int, w
 def process_year_files(files_l: list, region_name: str, bucket_name: str):
     # ic(files_l)
     s3_client = initialize_s3_client(region_name)
-    s3 = boto3.resource("s3")
-    for filename in tqdm(files_l):
-        if len(filename) <= 5:
-            continue
-        if "year_average" in filename or "_data_error" in filename:
-            continue
-        else:
-            try:
-                obj = s3_client.get_object(Bucket=bucket_name, Key=filename)
-                data = obj["Body"]
-                non_unique_spatial = unique_values_spatial_check(filename=filename, data=data)
-                if non_unique_spatial:
-                    move_s3_file(non_unique_spatial, bucket_name, s3_client, note="non_unique_spatial")
-                    print("uploaded")
-                    continue
-                obj = s3_client.get_object(Bucket=bucket_name, Key=filename)
-                data = obj["Body"]
-                spatial_errors = csv_clean_spatial_check(filename=filename, data=data)
-                if spatial_errors:
-                    move_s3_file(spatial_errors, bucket_name, s3_client, note="missing_spatial")
-                    continue
-                if not non_unique_spatial and not spatial_errors:
-                    # s3_client.put_object(Body=data, Bucket=bucket_name, Key=filename)#f'year_average/avg_{year_folder}.csv')
-                    s3_object = s3.Object(bucket_name, filename)
-                    # print(s3_object)
-                    # print(s3_object.metadata)
-                    s3_object.metadata.update(
-                        {"lastmodified": datetime.now(tzutc()).strftime("%a, %d %b %Y %H:%M:%S %Z")}
-                    )
-                    # print(s3_object.metadata)
-                    # print(filename)
-                    s3_object.copy_from(
-                        CopySource={"Bucket": bucket_name, "Key": filename},
-                        Metadata=s3_object.metadata,
-                        MetadataDirective="REPLACE",
-                    )
-            except EmptyDataError as e:
-                move_s3_file(spatial_errors, bucket_name, s3_client, note="empty_data_error")
-            except s3.meta.client.exceptions.NoSuchKey as e:
-                move_s3_file(spatial_errors, bucket_name, s3_client, note="no_such_key_error")
+    s3_fs = initialize_s3_filesystem(region_name)
+
+    def process_file(filename):
+        return process_site_file(filename, bucket_name, s3_client, s3_fs)
+
+    # each file is a handful of S3 round trips; keep S3_MAX_WORKERS of them in flight
+    with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as executor:
+        cleaned_l = list(tqdm(executor.map(process_file, files_l), total=len(files_l)))
     print("TASK")
+    return [x for x in cleaned_l if x]
+
+
+@task(log_stdout=True, max_retries=5, retry_delay=timedelta(seconds=5))
+def convert_year_files_parquet(year_folder: str, region_name: str, bucket_name: str, convert: bool):
+    """Migrate a year's site CSVs that don't have a Parquet copy yet
+    - calculate_year_csv reads only 'year/site.parquet'; this finds every 'year/site.csv' without
+      one (cleaned before the flow wrote Parquet copies, or not reached by process_year_files
+      because of TOTAL_PROCESSED) and runs it through the same checks, which writes the copy
+    - Only runs when convert (CONVERT_PARQUET) is set; it is an extra full LIST of the year, and
+      every unconverted file is processed, so TOTAL_PROCESSED does not bound this work
+    - Runs after process_year_files and before calculate_year_csv, so each year is averaged over
+      all of its clean sites
+
+    Return (list): keys of the files cleaned here (tagged by tag_cleaned_files)
+    """
+    # the migration is a one-off; normal runs skip it without listing the year
+    if not convert:
+        return []
+    if year_folder in ("year_average", "_data_error"):
+        return []
+    files_l = aws_year_files(year_folder, bucket_name, region_name)
+    converted = {x.rsplit(".", 1)[0] for x in files_l if x.endswith(".parquet")}
+    files_l = [x for x in files_l if x.endswith(".csv") and x.rsplit(".", 1)[0] not in converted]
+    if not files_l:
+        return []
+    s3_client = initialize_s3_client(region_name)
+    s3_fs = initialize_s3_filesystem(region_name)
+
+    def process_file(filename):
+        return process_site_file(filename, bucket_name, s3_client, s3_fs)
+
+    with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as executor:
+        cleaned_l = list(tqdm(executor.map(process_file, files_l), total=len(files_l), desc=year_folder))
+    return [x for x in cleaned_l if x]
 
 
 @task(log_stdout=True, max_retries=5, retry_delay=timedelta(seconds=5))
-def calculate_year_csv(year_folder, finished_files, bucket_name, region_name, calc_all: bool, wait_for: str):
-    print(finished_files)
+def tag_cleaned_files(
+    cleaned_l: List[list], converted_l: List[list], region_name: str, bucket_name: str, role_arn: str = None
+):
+    """Tag every file cleaned this run with 'lastmodified'
+    - Submits one S3 Batch Operations job (S3PutObjectTagging) over a manifest of the cleaned
+      keys, so the tagging runs server-side instead of as one API call per file
+    - role_arn: IAM role S3 Batch Operations assumes; it needs s3:PutObjectTagging on the bucket
+      and s3:GetObject on the manifest. If not given, falls back to per-file put_object_tagging
+    """
+    cleaned_l = list(chain.from_iterable(cleaned_l + converted_l))
+    if not cleaned_l:
+        return
+    tag_set = [{"Key": "lastmodified", "Value": datetime.now(tzutc()).isoformat()}]
+    s3_client = initialize_s3_client(region_name)
+    if not role_arn:
+        # one call per file; the shared client's pool holds a connection per thread (S3_MAX_POOL_CONNECTIONS)
+        def tag_file(filename):
+            s3_client.put_object_tagging(Bucket=bucket_name, Key=filename, Tagging={"TagSet": tag_set})
+
+        with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as executor:
+            list(tqdm(executor.map(tag_file, cleaned_l), total=len(cleaned_l)))
+        return
+
+    # manifest rows are 'bucket,key' with URL-encoded keys
+    manifest = "".join(f"{bucket_name},{quote(x)}\n" for x in cleaned_l)
+    manifest_key = f'{BATCH_MANIFEST_FOLDER}/cleaned-{datetime.now(tzutc()).strftime("%Y%m%d%H%M%S")}.csv'
+    manifest_etag = s3_client.put_object(Body=manifest, Bucket=bucket_name, Key=manifest_key)["ETag"].strip('"')
+    session = boto3.session.Session()
+    account_id = session.client("sts", region_name=region_name).get_caller_identity()["Account"]
+    job = session.client("s3control", region_name=region_name).create_job(
+        AccountId=account_id,
+        ConfirmationRequired=False,
+        Operation={"S3PutObjectTagging": {"TagSet": tag_set}},
+        Manifest={
+            "Spec": {"Format": "S3BatchOperations_CSV_20180820", "Fields": ["Bucket", "Key"]},
+            "Location": {"ObjectArn": f"arn:aws:s3:::{bucket_name}/{manifest_key}", "ETag": manifest_etag},
+        },
+        Report={"Enabled": False},
+        ClientRequestToken=str(uuid.uuid4()),
+        Priority=10,
+        RoleArn=role_arn,
+        Description=f"Tag {len(cleaned_l)} cleaned NOAA site files",
+    )
+    print(f'S3 Batch Operations job {job["JobId"]}: tagging {len(cleaned_l)} files')
+
+
+@task(log_stdout=True, max_retries=5, retry_delay=timedelta(seconds=5))
+def calculate_year_csv(year_folder, finished_files, bucket_name, region_name, calc_all: bool):
     if not calc_all:
         # prevents this task from running on ALL files. It looks for a avg file for year in question; if exists, it skips that year.
-        if f"year_average/avg_{year_folder}.csv" in finished_files:
+        if f"year_average/avg_{year_folder}.parquet" in finished_files:
             print(year_folder)
             return
-    s3_client = initialize_s3_client(region_name)
+    s3_fs = initialize_s3_filesystem(region_name)
     files_l = aws_year_files(year_folder, bucket_name, region_name)
-    files_l = [x for x in files_l if len(x) > 6]
-    columns = "SITE_NUMBER,LATITUDE,LONGITUDE,ELEVATION,AVERAGE_TEMP,DEWP,STP,MIN,MAX,PRCP\n"
-    content = columns
-    for site in tqdm(files_l, desc=year_folder):
-        try:
-            obj = s3_client.get_object(Bucket=bucket_name, Key=site)
-            data = obj["Body"]
-            df1 = pd.read_csv(data)
-            average_temp = df1["TEMP"].mean()
-            average_dewp = df1["DEWP"].mean()
-            average_stp = df1["STP"].mean()
-            average_min = df1["MIN"].mean()
-            average_max = df1["MAX"].mean()
-            average_prcp = df1["PRCP"].mean()
-            site_number = df1["STATION"].unique()
-            latitude = df1["LATITUDE"].unique()
-            longitude = df1["LONGITUDE"].unique()
-            elevation = df1["ELEVATION"].unique()
-            row = f"{site_number},{latitude},{longitude},{elevation},{average_temp},{average_dewp},{average_stp},{average_min},{average_max},{average_prcp}\n"
-            content += row
-        except EmptyDataError as e:
-            pass
-        except pd.errors.ParserError as e:
-            pass
-    s3_client.put_object(Body=content, Bucket=bucket_name, Key=f"year_average/avg_{year_folder}.csv")
+    files_l = [f"{bucket_name}/{x}" for x in files_l if x.endswith(".parquet")]
+    if not files_l:
+        return
+    # one scan over every site file in the year; Arrow reads the fragments concurrently
+    dataset = ds.dataset(files_l, format="parquet", filesystem=s3_fs, schema=SITE_PARQUET_SCHEMA)
+    # each site file has its own dictionary for the spatial columns; unify them (dictionaries only, the
+    # rows stay indices) so the group keys are consistent across files
+    records = dataset.to_table().unify_dictionaries()
+    # spatial fields are constant per site file (see process_year_files), so this is one group per site
+    averages = records.group_by(SPATIAL_COLUMNS).aggregate([(x, "mean") for x in MEASUREMENT_COLUMNS])
+    averages = pa.table(
+        {
+            "SITE_NUMBER": averages["STATION"],
+            "LATITUDE": averages["LATITUDE"],
+            "LONGITUDE": averages["LONGITUDE"],
+            "ELEVATION": averages["ELEVATION"],
+            "AVERAGE_TEMP": averages["TEMP_mean"],
+            "DEWP": averages["DEWP_mean"],
+            "STP": averages["STP_mean"],
+            "MIN": averages["MIN_mean"],
+            "MAX": averages["MAX_mean"],
+            "PRCP": averages["PRCP_mean"],
+        }
+    )
+    # one row per site, so decoding the station keys just for the sort order is cheap
+    averages = averages.take(pc.sort_indices(averages["SITE_NUMBER"].cast(pa.string())))
+    # spatial strings repeat per site; dictionary encode them and store the averages typed
+    with s3_fs.open_output_stream(f"{bucket_name}/year_average/avg_{year_folder}.parquet") as data:
+        pq.write_table(
+            averages,
+            data,
+            compression="snappy",
+            use_dictionary=["SITE_NUMBER", "LATITUDE", "LONGITUDE", "ELEVATION"],
+        )
 
 
 # IF REGISTERING FOR THE CLOUD, CREATE A LOCAL ENVIRONMENT VARIALBE FOR 'EXECTOR' BEFORE REGISTERING
@@ -358,7 +561,11 @@ def calculate_year_csv(year_folder, finished_files, bucket_name, region_name, ca
 #         },
 #     )
 # else:
-executor = LocalDaskExecutor(scheduler="threads", num_workers=16)
+# local Dask cluster of worker processes, so CSV parsing and the per-file checks in different tasks
+# don't contend on one GIL; S3 clients/filesystems are built inside each worker by the tasks themselves
+executor = DaskExecutor(
+    cluster_kwargs={"n_workers": 8, "threads_per_worker": DASK_THREADS_PER_WORKER, "processes": True}
+)
 
 
 with Flow(name="NOAA files: Clean and Calc", executor=executor) as flow:
@@ -369,22 +576,42 @@ with Flow(name="NOAA files: Clean and Calc", executor=executor) as flow:
     min_old = Parameter("MINUTES_OLD", default=1)  # 2880)
     time_less_than = Parameter("TIME_LESS_THAN", default=True)
     calc_all = Parameter("CALC_ALL_YEARS", default=False)
+    convert_parquet = Parameter("CONVERT_PARQUET", default=False)
+    batch_role_arn = Parameter("BATCH_ROLE_ARN", default=None)
     t1_aws_years = fetch_aws_folders(region_name, bucket_name)
     t2_all_files = aws_all_year_files.map(
         t1_aws_years, unmapped(bucket_name), unmapped(region_name), unmapped(min_old), unmapped(time_less_than)
     )
     t3_map_prep_l = aws_lists_prep_for_map(t2_all_files, map_list_size, total_processed)
     t4_clean_complete = process_year_files.map(mapped(t3_map_prep_l), unmapped(region_name), unmapped(bucket_name))
+    t5_convert_complete = convert_year_files_parquet.map(
+        mapped(t1_aws_years),
+        unmapped(region_name),
+        unmapped(bucket_name),
+        unmapped(convert_parquet),
+        upstream_tasks=[unmapped(t4_clean_complete)],
+    )
+    # only tag_cleaned_files needs the cleaned keys; later steps just wait on the cleaning (upstream_tasks)
+    clean_files_tagged = tag_cleaned_files(
+        t4_clean_complete, t5_convert_complete, region_name, bucket_name, batch_role_arn
+    )
     calc_files_done = aws_all_year_files(
-        "year_average", bucket_name, region_name, min_old, time_less_than, wait_for=t4_clean_complete
+        "year_average",
+        bucket_name,
+        region_name,
+        min_old,
+        time_less_than,
+        file_suffix=".parquet",
+        upstream_tasks=[t4_clean_complete],
     )
-    t5_calc_complete = calculate_year_csv.map(
+    # each year waits on its own Parquet migration (returns at once unless CONVERT_PARQUET)
+    t6_calc_complete = calculate_year_csv.map(
         mapped(t1_aws_years),
         unmapped(calc_files_done),
         unmapped(bucket_name),
         unmapped(region_name),
         unmapped(calc_all),
-        unmapped(t4_clean_complete),
+        upstream_tasks=[t5_convert_complete],
     )
 
 flow.run_config = LocalRun(working_dir="/home/share/github/1-NOAA-Data-Download-Cleaning-Verification")
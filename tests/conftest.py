@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# flow.py is a standalone Prefect script, not an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,209 @@
+import io
+
+import boto3
+import pyarrow.parquet as pq
+import pytest
+from botocore.stub import Stubber
+from pyarrow import fs as pafs
+
+import flow
+from flow import (
+    S3_LIST_SHARD_BOUNDS,
+    S3_MAX_POOL_CONNECTIONS,
+    SITE_COLUMN_TYPES,
+    calculate_year_csv,
+    csv_clean_spatial_check,
+    initialize_s3_client,
+    list_s3_objects,
+    read_site_csv,
+    unique_values_spatial_check,
+)
+
+FILENAME = "2020/01001099999.csv"
+HEADER = '"STATION","DATE","LATITUDE","LONGITUDE","ELEVATION","TEMP","DEWP","STP","MIN","MAX","PRCP"\n'
+
+
+def site_csv(*rows):
+    return io.BytesIO((HEADER + "".join(rows)).encode())
+
+
+def test_constant_spatial_columns_pass_both_checks():
+    records = read_site_csv(
+        site_csv(
+            '"01001099999","2020-01-01","70.9333333","-8.6666667","9.0",30.1,25.0,10.5,20.0,35.2,0.00\n',
+            '"01001099999","2020-01-02","70.9333333","-8.6666667","9.0",31.4,26.1,11.0,21.3,36.0,0.12\n',
+        )
+    )
+    assert unique_values_spatial_check(FILENAME, records) is None
+    assert csv_clean_spatial_check(FILENAME, records) is None
+
+
+def test_changed_spatial_value_is_non_unique():
+    records = read_site_csv(
+        site_csv(
+            '"01001099999","2020-01-01","70.9333333","-8.6666667","9.0",30.1,25.0,10.5,20.0,35.2,0.00\n',
+            '"01001099999","2020-01-02","70.93","-8.6666667","9.0",31.4,26.1,11.0,21.3,36.0,0.12\n',
+        )
+    )
+    assert unique_values_spatial_check(FILENAME, records) == FILENAME
+
+
+def test_blank_spatial_column_is_missing():
+    records = read_site_csv(
+        site_csv(
+            '"01001099999","2020-01-01","","-8.6666667","9.0",30.1,25.0,10.5,20.0,35.2,0.00\n',
+            '"01001099999","2020-01-02",,"-8.6666667","9.0",31.4,26.1,11.0,21.3,36.0,0.12\n',
+        )
+    )
+    assert unique_values_spatial_check(FILENAME, records) is None
+    assert csv_clean_spatial_check(FILENAME, records) == FILENAME
+
+
+def test_partly_blank_spatial_column_is_missing():
+    records = read_site_csv(
+        site_csv(
+            '"01001099999","2020-01-01","70.9333333","-8.6666667","9.0",30.1,25.0,10.5,20.0,35.2,0.00\n',
+            '"01001099999","2020-01-02","70.9333333","-8.6666667","",31.4,26.1,11.0,21.3,36.0,0.12\n',
+        )
+    )
+    assert csv_clean_spatial_check(FILENAME, records) == FILENAME
+
+
+def test_padded_header_names_get_site_column_types():
+    data = io.BytesIO(
+        (
+            '"STATION"," DATE"," LATITUDE ","LONGITUDE ","ELEVATION","TEMP"\n'
+            '"01001099999","2020-01-01","70.9333333","-8.6666667","9.0",30.1\n'
+        ).encode()
+    )
+    records = read_site_csv(data)
+    assert records.column_names == ["STATION", "DATE", "LATITUDE", "LONGITUDE", "ELEVATION", "TEMP"]
+    assert records.schema.field("LATITUDE").type == SITE_COLUMN_TYPES["LATITUDE"]
+    assert unique_values_spatial_check(FILENAME, records) is None
+
+
+def test_header_only_file_is_missing():
+    records = read_site_csv(site_csv())
+    assert unique_values_spatial_check(FILENAME, records) is None
+    assert csv_clean_spatial_check(FILENAME, records) == FILENAME
+
+
+def test_s3_client_pool_fits_every_thread_sharing_it():
+    assert initialize_s3_client("us-east-1").meta.config.max_pool_connections == S3_MAX_POOL_CONNECTIONS
+
+
+class SerialExecutor:
+    """Runs list_s3_objects' key ranges in order, so Stubber can match each request"""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+def list_request(start_after=None, token=None):
+    params = {"Bucket": "bucket", "Prefix": "2020", "MaxKeys": 1000}
+    if start_after:
+        params["StartAfter"] = start_after
+    if token:
+        params["ContinuationToken"] = token
+    return params
+
+
+def list_page(*keys, token=None):
+    page = {"IsTruncated": bool(token), "KeyCount": len(keys)}
+    if keys:
+        page["Contents"] = [{"Key": x} for x in keys]
+    if token:
+        page["NextContinuationToken"] = token
+    return page
+
+
+def test_list_s3_objects_splits_at_bounds_without_gaps_or_duplicates(monkeypatch):
+    monkeypatch.setattr(flow, "ThreadPoolExecutor", SerialExecutor)
+    keys = [
+        "2020/01001099999.csv",
+        "2020/1",  # equal to a bound: belongs to the range ending there, and is StartAfter for the next
+        "2020/10001099999.csv",
+        "2020/20001099999.csv",
+        "2020/90001099999.csv",
+        "2020/avg_2020.csv",  # after '9'; only the last (open-ended) range reaches these
+        "2020/zzz.csv",
+    ]
+    s3_client = boto3.session.Session().client("s3", region_name="us-east-1")
+    with Stubber(s3_client) as stubber:
+        # each range reads until it passes its upper bound; the first key past it ends the range
+        stubber.add_response("list_objects_v2", list_page(*keys[0:3], token="a"), list_request())
+        stubber.add_response("list_objects_v2", list_page(*keys[2:4], token="b"), list_request("2020/1"))
+        stubber.add_response("list_objects_v2", list_page(*keys[3:5], token="c"), list_request("2020/2"))
+        for bound in "345678":
+            stubber.add_response("list_objects_v2", list_page(*keys[4:6], token="d"), list_request(f"2020/{bound}"))
+        # last range: spans two pages, and the final page comes back without 'Contents'
+        stubber.add_response("list_objects_v2", list_page(*keys[4:6], token="e"), list_request("2020/9"))
+        stubber.add_response("list_objects_v2", list_page(keys[6], token="f"), list_request("2020/9", token="e"))
+        stubber.add_response("list_objects_v2", list_page(), list_request("2020/9", token="f"))
+        listed = [x["Key"] for x in list_s3_objects(s3_client, "bucket", "2020")]
+        stubber.assert_no_pending_responses()
+    assert listed == keys
+
+
+def test_list_s3_objects_empty_prefix(monkeypatch):
+    monkeypatch.setattr(flow, "ThreadPoolExecutor", SerialExecutor)
+    s3_client = boto3.session.Session().client("s3", region_name="us-east-1")
+    with Stubber(s3_client) as stubber:
+        stubber.add_response("list_objects_v2", list_page(), list_request())
+        for bound in S3_LIST_SHARD_BOUNDS:
+            stubber.add_response("list_objects_v2", list_page(), list_request(f"2020/{bound}"))
+        assert list_s3_objects(s3_client, "bucket", "2020") == []
+        stubber.assert_no_pending_responses()
+
+
+def test_calculate_year_csv_averages_each_site(monkeypatch, tmp_path):
+    sites = {
+        # written out of order; the averages come back sorted by site number
+        "2020/72000099999": site_csv(
+            '"72000099999","2020-01-01","40.5","-80.25","300.0",50.0,40.0,1000.0,45.0,55.0,0.10\n',
+            '"72000099999","2020-01-02","40.5","-80.25","300.0",60.0,42.0,1002.0,47.0,65.0,0.30\n',
+        ),
+        "2020/01001099999": site_csv(
+            '"01001099999","2020-01-01","70.9333333","-8.6666667","9.0",30.0,25.0,10.5,20.0,35.0,0.00\n',
+            '"01001099999","2020-01-02","70.9333333","-8.6666667","9.0",31.0,26.0,11.5,21.0,36.0,0.20\n',
+            '"01001099999","2020-01-03","70.9333333","-8.6666667","9.0",35.0,27.0,12.5,22.0,37.0,0.40\n',
+        ),
+        # no PRCP column; the dataset schema reads it as null
+        "2020/03005099999": io.BytesIO(
+            (
+                '"STATION","DATE","LATITUDE","LONGITUDE","ELEVATION","TEMP","DEWP","STP","MIN","MAX"\n'
+                '"03005099999","2020-01-01","58.2","-6.3","15.0",40.0,35.0,990.0,38.0,42.0\n'
+            ).encode()
+        ),
+    }
+    (tmp_path / "2020").mkdir()
+    (tmp_path / "year_average").mkdir()
+    for site, data in sites.items():
+        pq.write_table(read_site_csv(data), tmp_path / f"{site}.parquet")
+    files_l = [f"{x}.{ext}" for x in sites for ext in ("csv", "parquet")]
+    monkeypatch.setattr(flow, "initialize_s3_filesystem", lambda region_name: pafs.LocalFileSystem())
+    monkeypatch.setattr(flow, "aws_year_files", lambda year, bucket_name, region_name: files_l)
+
+    calculate_year_csv.run("2020", [], str(tmp_path), "us-east-1", calc_all=False)
+
+    averages = pq.read_table(tmp_path / "year_average" / "avg_2020.parquet").to_pylist()
+    assert [x["SITE_NUMBER"] for x in averages] == ["01001099999", "03005099999", "72000099999"]
+    assert [(x["LATITUDE"], x["LONGITUDE"], x["ELEVATION"]) for x in averages] == [
+        ("70.9333333", "-8.6666667", "9.0"),
+        ("58.2", "-6.3", "15.0"),
+        ("40.5", "-80.25", "300.0"),
+    ]
+    assert [x["AVERAGE_TEMP"] for x in averages] == pytest.approx([32.0, 40.0, 55.0])
+    assert [x["STP"] for x in averages] == pytest.approx([11.5, 990.0, 1001.0])
+    assert averages[0]["PRCP"] == pytest.approx(0.2)
+    assert averages[1]["PRCP"] is None
+    assert averages[2]["PRCP"] == pytest.approx(0.2)